@@ -1,9 +1,15 @@
 import os
 import logging
 import datetime
+from typing import List, Optional, Tuple
 
+import numba
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import plotly.graph_objects as go
 import streamlit as st
 from dotenv import load_dotenv
 
@@ -12,6 +18,7 @@ load_dotenv()
 
 # Configuration from .env
 DATA_PATH = os.getenv("BASE_PATH", "datalake")
+METADATA_FILE = "_metadata"
 
 # Logging setup for Streamlit
 logging.basicConfig(
@@ -39,32 +46,164 @@ def classificar_ativo(ticker):
     else:
         return 'Outros'
 
-@st.cache_data(ttl=60)
-def load_data(path: str) -> pd.DataFrame:
+# Compiled eagerly for float32 prices; the running sum is kept in float64 to avoid drift.
+# The input is declared read-only so zero-copy views of Arrow buffers (never writable) match it.
+@numba.njit(numba.float32[:](numba.types.Array(numba.float32, 1, 'A', readonly=True), numba.int64), cache=True)
+def sma(x: np.ndarray, w: int) -> np.ndarray:
+    """
+    Simple moving average in a single pass, keeping a running sum of the last `w` values.
+    Positions without `w` valid observations in the window are NaN, like pandas' rolling().mean().
+    """
+    n = x.shape[0]
+    out = np.empty(n, dtype=np.float32)
+    s = 0.0
+    nobs = 0
+    for i in range(n):
+        v = x[i]
+        if not np.isnan(v):
+            s += v
+            nobs += 1
+        if i >= w:
+            old = x[i - w]
+            if not np.isnan(old):
+                s -= old
+                nobs -= 1
+        out[i] = s / w if nobs == w else np.nan
+    return out
+
+def _partition_filter(start_date: datetime.date, end_date: datetime.date) -> ds.Expression:
+    """
+    Builds a filter for the days in the range from two bounds, whatever its length: the
+    year bounds prune the `ano` partitions and the YYYYMMDD key bounds select the days.
+    """
+    day_key = (
+        ds.field('ano').cast(pa.int32()) * 10000
+        + ds.field('mes').cast(pa.int32()) * 100
+        + ds.field('dia').cast(pa.int32())
+    )
+    start_key = start_date.year * 10000 + start_date.month * 100 + start_date.day
+    end_key = end_date.year * 10000 + end_date.month * 100 + end_date.day
+
+    return (
+        (ds.field('ano') >= start_date.year)
+        & (ds.field('ano') <= end_date.year)
+        & (day_key >= start_key)
+        & (day_key <= end_key)
+    )
+
+def _open_dataset(path: str) -> ds.Dataset:
+    """
+    Opens the Data Lake from the _metadata index written by the ingestor, which holds
+    the footers of every file, and falls back to a directory scan when it is missing.
+    """
+    metadata_path = os.path.join(path, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        return ds.parquet_dataset(metadata_path, partitioning='hive')
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+def _lake_mtime(path: str) -> float:
+    """
+    Last modification time of the Data Lake. The ingestor rewrites the _metadata index on
+    every save, so its mtime is enough; otherwise the newest partition directory is used.
+    """
+    metadata_path = os.path.join(path, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        return os.path.getmtime(metadata_path)
+    return max(os.path.getmtime(root) for root, _, _ in os.walk(path))
+
+def _fragment_tickers(fragment: ds.Fragment) -> List[str]:
+    """
+    Tickers stored in a file: read from its Ticker=XXXX partition, or from the Ticker
+    column for files of a Data Lake that has not been migrated yet.
+    """
+    keys = ds.get_partition_keys(fragment.partition_expression)
+    if 'Ticker' in keys:
+        return [keys['Ticker']]
+    return pc.unique(fragment.to_table(columns=['Ticker'])['Ticker']).to_pylist()
+
+def _fragment_dates(fragment: ds.Fragment) -> Optional[Tuple[datetime.date, datetime.date]]:
+    """
+    First and last day stored in a file, from the Datetime statistics of its row groups
+    (already in the footers) and only reading the column when they are missing.
+    """
+    stats = [row_group.statistics.get('Datetime') for row_group in fragment.row_groups]
+    if stats and all(stat and stat.get('min') is not None for stat in stats):
+        first, last = min(stat['min'] for stat in stats), max(stat['max'] for stat in stats)
+    else:
+        bounds = pc.min_max(fragment.to_table(columns=['Datetime'])['Datetime'])
+        first, last = bounds['min'].as_py(), bounds['max'].as_py()
+
+    if first is None:
+        return None
+    return pd.Timestamp(first).date(), pd.Timestamp(last).date()
+
+@st.cache_data(max_entries=1)
+def lake_index(path: str, mtime: float) -> Tuple[pd.DataFrame, Optional[datetime.date], Optional[datetime.date]]:
     """
-    Loads data from the Parquet Data Lake.
-    Uses caching to improve performance.
+    Loads the tickers of the Parquet Data Lake and its date range, which is all the
+    sidebar filters need, from the partition keys and footer statistics of its files
+    without scanning any column. `mtime` is only part of the cache key, so the index is
+    recomputed when the ingestor writes new files and not on every rerun.
     """
     try:
-        if not os.path.exists(path):
-            logger.warning(f"Data Lake path not found: {path}")
-            return pd.DataFrame()
-            
-        df = pd.read_parquet(path, engine='fastparquet')
-        
-        # Ensure Datetime is datetime type
-        if 'Datetime' in df.columns:
-            df['Datetime'] = pd.to_datetime(df['Datetime'])
-            
+        tickers = set()
+        min_date, max_date = None, None
+
+        for fragment in _open_dataset(path).get_fragments():
+            dates = _fragment_dates(fragment)
+            if dates is None:
+                continue
+            tickers.update(_fragment_tickers(fragment))
+            min_date = dates[0] if min_date is None else min(min_date, dates[0])
+            max_date = dates[1] if max_date is None else max(max_date, dates[1])
+
+        df = pd.DataFrame({'Ticker': sorted(tickers)})
+        if df.empty:
+            return df, None, None
+
         # Add Asset Classification
-        if 'Ticker' in df.columns:
-            df['Tipo de Ativo'] = df['Ticker'].apply(classificar_ativo)
+        df['Tipo de Ativo'] = df['Ticker'].apply(classificar_ativo)
         
-        return df
+        return df, min_date, max_date
     except Exception as e:
         logger.error(f"Error loading data: {e}")
         st.error(f"Error loading data: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), None, None
+
+@st.cache_data(ttl=60)
+def load_filtered(path: str, ticker: str, start_date: datetime.date, end_date: datetime.date) -> pa.Table:
+    """
+    Loads only the rows of the selected asset and period, sorted by Datetime and with
+    the SMA 20 column, pushing the ticker and date filters down into the Parquet scan:
+    partitions outside the period are never opened and row groups are skipped using
+    their Ticker/Datetime statistics. The result stays an Arrow table, which Streamlit
+    renders without a pandas round trip.
+    """
+    try:
+        dataset = _open_dataset(path)
+        start = pd.Timestamp(start_date)
+        end = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+        expr = (
+            _partition_filter(start_date, end_date)
+            & (ds.field('Ticker') == ticker)
+            & (ds.field('Datetime') >= start)
+            & (ds.field('Datetime') < end)
+        )
+
+        table = dataset.to_table(
+            columns=['Datetime', 'Ticker', 'Close'],
+            filter=expr
+        ).sort_by('Datetime')
+
+        # Calculate Moving Average (20 periods) straight over the Arrow buffer
+        close = table['Close'].combine_chunks()
+        if close.type != pa.float32():
+            close = close.cast(pa.float32())
+        return table.append_column('SMA 20', pa.array(sma(close.to_numpy(zero_copy_only=False), 20), type=pa.float32()))
+    except Exception as e:
+        logger.error(f"Error loading data for {ticker}: {e}")
+        st.error(f"Error loading data for {ticker}: {e}")
+        return pa.table({})
 
 def main():
     st.title("Financial Market Data Analysis")
@@ -73,7 +212,7 @@ def main():
         st.warning("Data Lake directory not found. Please wait for the ingestor script to generate data.")
         return
 
-    df = load_data(DATA_PATH)
+    df, min_date, max_date = lake_index(DATA_PATH, _lake_mtime(DATA_PATH))
 
     if df.empty:
         st.info("No data available in the Data Lake yet.")
@@ -104,9 +243,6 @@ def main():
     selected_asset = st.sidebar.selectbox("Select Asset", available_assets)
 
     # Date Filter
-    min_date = df['Datetime'].min().date()
-    max_date = df['Datetime'].max().date()
-    
     date_range = st.sidebar.date_input(
         "Select Date Range",
         value=(min_date, max_date),
@@ -119,29 +255,26 @@ def main():
     else:
         start_date = end_date = date_range[0] if isinstance(date_range, tuple) else date_range
 
+    if selected_asset is None:
+        st.info("No assets available for the selected asset types.")
+        return
+
     # Filter Data
-    filtered_df = df[
-        (df['Ticker'] == selected_asset) & 
-        (df['Datetime'].dt.date >= start_date) &
-        (df['Datetime'].dt.date <= end_date)
-    ].sort_values('Datetime')
+    filtered_table = load_filtered(DATA_PATH, selected_asset, start_date, end_date)
 
-    if filtered_df.empty:
+    if filtered_table.num_rows == 0:
         st.warning(f"No data found for {selected_asset} in the selected period.")
         return
 
-    # Calculate Moving Average (20 periods)
-    filtered_df['SMA 20'] = filtered_df['Close'].rolling(window=20).mean()
-
     # KPIs
     st.header(f"Overview: {selected_asset}")
     
     col1, col2, col3 = st.columns(3)
     
-    current_price = filtered_df['Close'].iloc[-1]
-    start_price = filtered_df['Close'].iloc[0]
+    # The KPIs come from the same table as the chart, so both always describe the same rows
+    close = filtered_table['Close'].to_numpy()
+    start_price, current_price, volume_records = close[0], close[-1], filtered_table.num_rows
     variation = ((current_price - start_price) / start_price) * 100
-    volume_records = len(filtered_df)
 
     col1.metric("Last Price", f"R$ {current_price:.2f}")
     col2.metric("Variation (Day)", f"{variation:.2f}%")
@@ -150,16 +283,16 @@ def main():
     # Charts
     st.subheader("Price Evolution")
     
-    fig = px.line(
-        filtered_df, 
-        x='Datetime', 
-        y=['Close', 'SMA 20'], 
-        title=f'{selected_asset} - Historical Price',
-        template='plotly_white',
-        color_discrete_map={'Close': '#1f77b4', 'SMA 20': '#ff7f0e'}
-    )
+    # Traces are built from NumPy views of the Arrow columns, skipping the DataFrame px.line would assemble
+    datetimes = filtered_table['Datetime'].to_numpy()
+    fig = go.Figure([
+        go.Scatter(x=datetimes, y=close, name='Close', mode='lines', line_color='#1f77b4'),
+        go.Scatter(x=datetimes, y=filtered_table['SMA 20'].to_numpy(), name='SMA 20', mode='lines', line_color='#ff7f0e'),
+    ])
     
     fig.update_layout(
+        title=f'{selected_asset} - Historical Price',
+        template='plotly_white',
         xaxis_title="Time",
         yaxis_title="Price (BRL)",
         hovermode="x unified",
@@ -172,7 +305,8 @@ def main():
     st.subheader("Raw Data")
     
     st.dataframe(
-        filtered_df[['Datetime', 'Ticker', 'Close']].sort_values('Datetime', ascending=False),
+        # Already sorted ascending for the chart; taking the rows in reverse avoids sorting again
+        filtered_table.select(['Datetime', 'Ticker', 'Close']).take(np.arange(filtered_table.num_rows - 1, -1, -1)),
         hide_index=True
     )
 
@@ -1,11 +1,19 @@
 import time
 import os
-import datetime
 import logging
-from typing import List, Optional
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import quote
 
+import numpy as np
+import orjson
 import pandas as pd
-import requests
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from curl_cffi import requests as cffi_requests
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -16,6 +24,21 @@ ASSETS_ENV_STR = os.getenv("ASSETS", "")
 ASSETS: List[str] = [asset.strip() for asset in ASSETS_ENV_STR.split(",")] if ASSETS_ENV_STR else []
 INTERVAL_SECONDS: int = int(os.getenv("INTERVAL_SECONDS", "3600"))
 BASE_PATH: str = os.getenv("BASE_PATH", "datalake")
+FETCH_WORKERS: int = int(os.getenv("FETCH_WORKERS", "4"))
+# Minimum spacing between two Brapi requests, shared by all workers
+REQUEST_INTERVAL_SECONDS: float = float(os.getenv("REQUEST_INTERVAL_SECONDS", "2"))
+
+# Ticker-major and yearly: the data is one bar per ticker per trading day, so finer
+# partitions would hold a single row per file
+PARTITION_COLS: List[str] = ['Ticker', 'ano']
+METADATA_FILE: str = '_metadata'
+
+# Footers of the files indexed in each Data Lake's _metadata, so saves can update the
+# index without re-reading every file
+_indexed_footers: Dict[str, Dict[str, pq.FileMetaData]] = {}
+# Data Lakes whose _metadata could not be updated (e.g. mixed schemas before a migration);
+# saves stop touching their index until it is rebuilt
+_failed_indexes: Set[str] = set()
 
 # Logging setup
 logging.basicConfig(
@@ -25,6 +48,42 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Long-lived worker pool: each worker keeps its own HTTP session, so connections to
+# Brapi are kept alive between cycles
+EXECUTOR = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='brapi')
+_thread_local = threading.local()
+
+# Shared rate limiter: the monotonic time at which the next request may start
+_rate_lock = threading.Lock()
+_next_request_at: float = 0.0
+
+def get_session() -> cffi_requests.Session:
+    """
+    Returns the HTTP session of the current worker thread, creating it on first use.
+    """
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        # CRIANDO UMA SESSÃO DISFARÇADA DE NAVEGADOR (CHROME)
+        # curl_cffi reproduces Chrome's TLS handshake and headers, and does the HTTP work in C
+        session = cffi_requests.Session(impersonate='chrome')
+        _thread_local.session = session
+    return session
+
+def wait_for_request_slot() -> None:
+    """
+    Blocks until the current worker may send a request. Slots are handed out under a
+    lock, REQUEST_INTERVAL_SECONDS apart, so the pool as a whole keeps the same request
+    rate as a single sequential fetcher while the responses are awaited in parallel.
+    """
+    global _next_request_at
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_request_at)
+        _next_request_at = slot + REQUEST_INTERVAL_SECONDS
+
+    if slot > now:
+        time.sleep(slot - now)
+
 def is_market_open() -> bool:
     """
     Verifica se a B3 (Bolsa de Valores do Brasil) está aberta.
@@ -42,9 +101,60 @@ def is_market_open() -> bool:
         
     return False
 
+def fetch_batch(lote_atual: List[str], assets: List[str], token: str) -> List[pd.Series]:
+    """
+    Fetches the historical prices of a single batch of tickers from the Brapi API,
+    returning one close price Series (indexed by Datetime) per ticker.
+    Failures are logged and yield an empty list so other batches are not affected.
+    """
+    tickers_str = ','.join(lote_atual)
+    url = f"https://brapi.dev/api/quote/{tickers_str}?range=3mo&interval=1d"
+    
+    if token:
+        url += f"&token={token}"
+
+    series = []
+    try:
+        # Rate Limiting: wait for a slot shared by all workers to avoid spam blocking
+        wait_for_request_slot()
+        response = get_session().get(url, timeout=15)
+        
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            
+            if 'error' in data:
+                logger.error(f"Brapi returned an error for batch {tickers_str}: {data['error']}")
+                return series
+
+            if 'results' in data:
+                for result in data['results']:
+                    # The symbol from Brapi is without .SA, let's find the original to maintain compatibility
+                    symbol = result.get('symbol', '')
+                    original_asset = next((a for a in assets if a.replace('.SA', '') == symbol), symbol)
+                    
+                    historical_data = result.get('historicalDataPrice') or []
+                    if not historical_data:
+                        continue
+
+                    # Convert the whole history at once instead of one Timestamp per item
+                    dates = np.array([item['date'] for item in historical_data], dtype=np.int64)
+                    closes = np.array([item.get('close') for item in historical_data], dtype=np.float64)
+                    index = pd.to_datetime(dates, unit='s', utc=True).tz_convert('America/Sao_Paulo').tz_localize(None)
+
+                    close_series = pd.Series(closes, index=index, name=original_asset)
+                    series.append(close_series[~close_series.index.duplicated(keep='last')])
+        else:
+            logger.error(f"Error in batch {tickers_str}: HTTP {response.status_code}")
+            
+    except Exception as e:
+        logger.error(f"Connection failure fetching batch {tickers_str}: {e}")
+        
+    return series
+
 def fetch_data(assets: List[str]) -> pd.DataFrame:
     """
     Fetches the latest market data for the given assets using Brapi API.
+    Batches are requested concurrently by a small pool of workers.
     """
     if not assets:
         logger.warning("No assets defined for ingestion. Check your .env file.")
@@ -54,64 +164,40 @@ def fetch_data(assets: List[str]) -> pd.DataFrame:
     
     brapi_assets = [asset.replace('.SA', '') for asset in assets]
     
-    # CRIANDO UMA SESSÃO DISFARÇADA DE NAVEGADOR (CHROME)
-    session = requests.Session()
-    session.headers.update({
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36'
-    })
-    
     token = os.getenv("BRAPI_TOKEN", "")
     tamanho_lote = 1 # Restrição da API Brapi Free (1 ativo por requisição)
-    records = []
-
-    for i in range(0, len(brapi_assets), tamanho_lote):
-        lote_atual = brapi_assets[i:i + tamanho_lote]
-        tickers_str = ','.join(lote_atual)
-        url = f"https://brapi.dev/api/quote/{tickers_str}?range=3mo&interval=1d"
-        
-        if token:
-            url += f"&token={token}"
+    lotes = [brapi_assets[i:i + tamanho_lote] for i in range(0, len(brapi_assets), tamanho_lote)]
+    series = []
 
+    futures = [EXECUTOR.submit(fetch_batch, lote, assets, token) for lote in lotes]
+    for future in futures:
         try:
-            response = session.get(url, timeout=15)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                if 'error' in data:
-                    logger.error(f"Brapi returned an error for batch {tickers_str}: {data['error']}")
-                    continue
-
-                if 'results' in data:
-                    for result in data['results']:
-                        # The symbol from Brapi is without .SA, let's find the original to maintain compatibility
-                        symbol = result.get('symbol', '')
-                        original_asset = next((a for a in assets if a.replace('.SA', '') == symbol), symbol)
-                        
-                        historical_data = result.get('historicalDataPrice', [])
-                        for item in historical_data:
-                            records.append({
-                                'Datetime': pd.to_datetime(item['date'], unit='s', utc=True).tz_convert('America/Sao_Paulo').tz_localize(None),
-                                'Ticker': original_asset,
-                                'Close': item['close']
-                            })
-            else:
-                logger.error(f"Error in batch {tickers_str}: HTTP {response.status_code}")
-                
+            series.extend(future.result())
         except Exception as e:
-            logger.error(f"Connection failure fetching batch {tickers_str}: {e}")
-            
-        # Rate Limiting: Pause between batches to avoid spam blocking
-        time.sleep(2)
+            logger.error(f"Unexpected failure in fetch worker: {e}")
 
-    df = pd.DataFrame(records)
-    if df.empty:
+    if not series:
         logger.warning("No historical data returned from Brapi API.")
         return pd.DataFrame()
         
-    # Transform the dataframe to have 'Datetime' as index and 'Ticker' as columns, matching the previous yfinance structure
-    df_pivot = df.pivot_table(index='Datetime', columns='Ticker', values='Close')
-    return df_pivot
+    # Align the per-ticker series into a frame with 'Datetime' as index and 'Ticker' as columns, matching the previous yfinance structure
+    df_wide = pd.concat(series, axis=1).sort_index()
+    df_wide.index.name = 'Datetime'
+    df_wide.columns.name = 'Ticker'
+    return df_wide
+
+def optimize_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcasts the partition columns to the smallest integer types, Close to float32
+    (plenty for prices quoted in cents) and stores Ticker as a categorical, which
+    pyarrow writes as a dictionary-encoded column.
+    """
+    df['Close'] = df['Close'].astype(np.float32)
+    df['ano'] = df['ano'].astype('int16')
+    df['mes'] = df['mes'].astype('int8')
+    df['dia'] = df['dia'].astype('int8')
+    df['Ticker'] = df['Ticker'].astype('category')
+    return df
 
 def process_data(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -121,63 +207,270 @@ def process_data(df: pd.DataFrame) -> pd.DataFrame:
         return pd.DataFrame()
 
     try:
-        df.index.name = 'Datetime'
-        df_reset = df.reset_index()
-
-        if 'Datetime' not in df_reset.columns:
-            logger.error("Datetime column missing after reset_index.")
-            return pd.DataFrame()
+        # Flatten the (T x N) close matrix row by row, dropping missing prices in the same pass
+        close = df.to_numpy(dtype=np.float64)
+        n_times, n_tickers = close.shape
+        close_flat = close.ravel(order='C')
+        mask = ~np.isnan(close_flat)
 
-        df_melted = df_reset.melt(
-            id_vars=['Datetime'], 
-            var_name='Ticker', 
-            value_name='Close'
-        )
+        datetimes = pd.DatetimeIndex(np.repeat(df.index.values, n_tickers)[mask])
 
-        df_melted = df_melted.dropna(subset=['Close'])
-
-        df_melted['ano'] = df_melted['Datetime'].dt.year
-        df_melted['mes'] = df_melted['Datetime'].dt.month
-        df_melted['dia'] = df_melted['Datetime'].dt.day
+        df_melted = pd.DataFrame({
+            'Datetime': datetimes,
+            'Ticker': np.tile(df.columns.to_numpy(), n_times)[mask],
+            'Close': close_flat[mask],
+            'ano': datetimes.year,
+            'mes': datetimes.month,
+            'dia': datetimes.day,
+        })
         
-        return df_melted
+        return optimize_dtypes(df_melted)
 
     except Exception as e:
         logger.error(f"Error processing data: {e}")
         return pd.DataFrame()
 
-def save_to_datalake(df: pd.DataFrame, base_path: str) -> None:
+def _relative_file_path(file_path: str, base_path: str) -> str:
+    """Path of a data file relative to the Data Lake root, as stored in the _metadata index."""
+    return os.path.relpath(os.path.abspath(file_path), os.path.abspath(base_path)).replace(os.sep, '/')
+
+def _write_metadata_index(base_path: str, schema: pa.Schema, collector: List[pq.FileMetaData]) -> None:
     """
-    Saves the DataFrame to the Data Lake using Parquet format with Snappy compression.
+    Writes the combined _metadata file atomically, so readers never see a partial index.
     """
-    if df.empty:
+    metadata_path = os.path.join(base_path, METADATA_FILE)
+    tmp_path = metadata_path + '.tmp'
+    try:
+        pq.write_metadata(schema, tmp_path, metadata_collector=collector)
+        os.replace(tmp_path, metadata_path)
+    except Exception:
+        # write_metadata creates the file before appending the footers, so a failure leaves it behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _read_footers(base_path: str) -> Dict[str, pq.FileMetaData]:
+    """
+    Reads the footer of every Parquet file in the Data Lake, keyed by its relative path.
+    """
+    dataset = ds.dataset(base_path, format='parquet', partitioning='hive')
+    footers = {}
+
+    for fragment in dataset.get_fragments():
+        file_path = _relative_file_path(fragment.path, base_path)
+        metadata = fragment.metadata
+        metadata.set_file_path(file_path)
+        footers[file_path] = metadata
+
+    return footers
+
+def rebuild_metadata_index(base_path: str) -> None:
+    """
+    Rebuilds the _metadata index from the footers of every Parquet file in the Data Lake.
+    """
+    footers = _read_footers(base_path)
+    _indexed_footers[base_path] = footers
+
+    if not footers:
         return
 
+    schema = next(iter(footers.values())).schema.to_arrow_schema()
+    _write_metadata_index(base_path, schema, list(footers.values()))
+    _failed_indexes.discard(base_path)
+    logger.info(f"Metadata index rebuilt with {len(footers)} files.")
+
+def update_metadata_index(
+    base_path: str,
+    schema: pa.Schema,
+    written: Dict[str, pq.FileMetaData],
+    replaced: List[str]
+) -> None:
+    """
+    Swaps the footers of the replaced files for those of the freshly written ones in the
+    _metadata index, so the dashboard can plan its scans from a single file instead of
+    walking every partition. The footers are kept in memory, so the lake is only read
+    once per process. After a failure the index is dropped and left alone until
+    rebuild_metadata_index succeeds, instead of re-reading every footer on each save.
+    """
+    if not written and not replaced:
+        return
+
+    if base_path in _failed_indexes:
+        return
+
+    metadata_path = os.path.join(base_path, METADATA_FILE)
+
+    try:
+        footers = _indexed_footers.get(base_path)
+        if footers is None:
+            footers = _read_footers(base_path)
+            _indexed_footers[base_path] = footers
+
+        for file_path in replaced:
+            footers.pop(file_path, None)
+        footers.update(written)
+
+        _write_metadata_index(base_path, schema, list(footers.values()))
+
+    except Exception as e:
+        logger.error(f"Error updating metadata index, disabling it until it is rebuilt: {e}")
+        _failed_indexes.add(base_path)
+        _indexed_footers.pop(base_path, None)
+        # A stale index would hide data from the dashboard, which falls back to a directory scan without it
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+
+def _partition_files(df: pd.DataFrame, base_path: str) -> List[str]:
+    """
+    Lists the Parquet files of the (Ticker, ano) partitions present in the DataFrame,
+    straight from their directories, so the rest of the lake is never listed.
+    """
+    files = []
+    for ticker, ano in df[['Ticker', 'ano']].astype({'Ticker': str}).drop_duplicates().itertuples(index=False):
+        # Partition values are URI-encoded by the writer, as in Ticker=PETR4.SA
+        partition_dir = os.path.join(base_path, f"Ticker={quote(ticker, safe='')}", f"ano={int(ano)}")
+        if os.path.isdir(partition_dir):
+            files.extend(
+                os.path.join(partition_dir, name) for name in sorted(os.listdir(partition_dir))
+                if name.endswith('.parquet')
+            )
+    return files
+
+def merge_existing_partitions(df: pd.DataFrame, base_path: str) -> Tuple[pd.DataFrame, List[str]]:
+    """
+    Combines the new rows with the rows already stored in the partitions they touch,
+    keeping the latest value for each (Datetime, Ticker). Also returns the paths of the
+    files holding those stored rows, which the rewritten partitions replace.
+    """
+    replaced = _partition_files(df, base_path)
+    if not replaced:
+        return df, []
+
+    dataset = ds.dataset(replaced, format='parquet', partitioning='hive', partition_base_dir=base_path)
+    existing = dataset.to_table(columns=list(df.columns)).to_pandas()
+    if existing.empty:
+        return df, replaced
+
+    merged = pd.concat([existing, df], ignore_index=True)
+    merged['Ticker'] = merged['Ticker'].astype(str)
+    merged = merged.drop_duplicates(subset=['Datetime', 'Ticker'], keep='last')
+    return optimize_dtypes(merged), replaced
+
+def save_to_datalake(df: pd.DataFrame, base_path: str) -> bool:
+    """
+    Upserts the DataFrame into the Data Lake using Parquet format with Zstandard (level 3) compression.
+    Each touched (Ticker, ano) partition is rewritten as a single file holding its old and new rows,
+    which keeps the file count at one per ticker and year. The new files get unique names, the _metadata index is switched over to
+    them and only then are the files they replace deleted, so readers never see a half-written file.
+    Returns whether the data was written.
+    """
+    if df.empty:
+        return False
+
     try:
-        current_time = datetime.datetime.now()
         os.makedirs(base_path, exist_ok=True)
+
+        df, replaced = merge_existing_partitions(df, base_path)
+        written = {}
+
+        def collect_metadata(written_file) -> None:
+            file_path = _relative_file_path(written_file.path, base_path)
+            metadata = written_file.metadata
+            metadata.set_file_path(file_path)
+            written[file_path] = metadata
         
         df.to_parquet(
             path=base_path,
-            engine='fastparquet',
-            partition_cols=['ano', 'mes', 'dia'],
-            compression='snappy',
-            index=False
+            engine='pyarrow',
+            partition_cols=PARTITION_COLS,
+            compression='zstd',
+            compression_level=3,
+            index=False,
+            existing_data_behavior='overwrite_or_ignore',
+            basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+            file_visitor=collect_metadata
         )
         
         logger.info(f"Data saved successfully to {base_path}")
 
+        file_schema = pa.Schema.from_pandas(df.drop(columns=PARTITION_COLS), preserve_index=False)
+        update_metadata_index(
+            base_path,
+            file_schema,
+            written,
+            [_relative_file_path(file_path, base_path) for file_path in replaced]
+        )
+
+        for file_path in replaced:
+            os.remove(file_path)
+
+        return True
+
     except Exception as e:
         logger.error(f"Error saving to Data Lake: {e}")
+        return False
+
+def filter_new_rows(df: pd.DataFrame, last_saved: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keeps the rows newer than the last row saved for their ticker, plus that last row
+    itself when its close changed (the current day's bar is updated during the session).
+    `last_saved` is indexed by Ticker with the Datetime and Close of that row.
+    """
+    if last_saved.empty:
+        return df
+
+    last = last_saved.reindex(df['Ticker'].astype(str))
+    last_datetime = last['Datetime'].to_numpy()
+    datetimes = df['Datetime'].to_numpy()
+
+    # Comparisons against NaT are False, so tickers never saved before are kept
+    is_new = ~(datetimes <= last_datetime)
+    is_updated = (datetimes == last_datetime) & (df['Close'].to_numpy() != last['Close'].to_numpy())
+    return df[is_new | is_updated]
+
+def update_last_saved(last_saved: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+    """Records the latest saved row of each ticker in `df`."""
+    latest = df.sort_values('Datetime').groupby('Ticker', observed=True).tail(1)
+    latest = latest.assign(Ticker=latest['Ticker'].astype(str)).set_index('Ticker')[['Datetime', 'Close']]
+    if last_saved.empty:
+        return latest
+    return pd.concat([last_saved.drop(latest.index, errors='ignore'), latest])
+
+def wait_for_next_tick(next_deadline: float) -> float:
+    """
+    Sleeps until the next tick, INTERVAL_SECONDS after the previous deadline, so the time spent
+    fetching and saving does not make ticks drift. When a cycle overruns, whole intervals are
+    skipped to get back on schedule. Returns the new deadline (time.monotonic() based).
+    """
+    next_deadline += INTERVAL_SECONDS
+    now = time.monotonic()
+
+    if now > next_deadline:
+        missed = int((now - next_deadline) // INTERVAL_SECONDS) + 1
+        logger.warning(f"Cycle overran the interval, skipping {missed} tick(s) to resynchronize.")
+        next_deadline += missed * INTERVAL_SECONDS
+
+    sleep_for = max(0.0, next_deadline - now)
+    logger.info(f"Sleeping for {sleep_for:.0f} seconds...")
+    time.sleep(sleep_for)
+    return next_deadline
 
 def main():
     logger.info("Starting Financial Data Ingestion Service...")
+
+    # Latest (Datetime, Close) written per ticker, so unchanged ticks are not rewritten
+    last_saved = pd.DataFrame({
+        'Datetime': pd.Series(dtype='datetime64[ns]'),
+        'Close': pd.Series(dtype=np.float32)
+    })
+
+    next_deadline = time.monotonic()
     
     while True:
         try:
             if not is_market_open():
                 logger.info("Mercado fechado (fora do horário comercial ou fim de semana). Aguardando próximo ciclo...")
-                time.sleep(INTERVAL_SECONDS)
+                next_deadline = wait_for_next_tick(next_deadline)
                 continue
 
             logger.info("Fetching market data...")
@@ -187,12 +480,16 @@ def main():
                 df_processed = process_data(df_raw)
                 
                 if not df_processed.empty:
-                    save_to_datalake(df_processed, BASE_PATH)
+                    df_new = filter_new_rows(df_processed, last_saved)
+
+                    if df_new.empty:
+                        logger.info("No new data since the last save. Skipping write.")
+                    elif save_to_datalake(df_new, BASE_PATH):
+                        last_saved = update_last_saved(last_saved, df_new)
                 else:
                     logger.warning("Processed data is empty.")
             
-            logger.info(f"Sleeping for {INTERVAL_SECONDS} seconds...")
-            time.sleep(INTERVAL_SECONDS)
+            next_deadline = wait_for_next_tick(next_deadline)
 
         except KeyboardInterrupt:
             logger.info("Service stopped by user.")
@@ -0,0 +1,58 @@
+import os
+import logging
+
+import pyarrow.dataset as ds
+
+from ingestor import BASE_PATH, optimize_dtypes, rebuild_metadata_index, save_to_datalake
+
+logger = logging.getLogger(__name__)
+
+def migrate_datalake(base_path: str) -> None:
+    """
+    One-shot migration of a Data Lake partitioned by ano/mes/dia (or
+    ano/mes/dia/Ticker) to the Ticker/ano layout. Rows are rewritten in place (the
+    lake may be a mounted volume) and the old files are removed only after the new
+    ones exist.
+    """
+    if not os.path.exists(base_path):
+        logger.warning(f"Data Lake path not found: {base_path}")
+        return
+
+    dataset = ds.dataset(base_path, format='parquet', partitioning='hive')
+    old_files = list(dataset.files)
+
+    if not old_files:
+        logger.info("Data Lake is empty, nothing to migrate.")
+        return
+
+    df = dataset.to_table(columns=['Datetime', 'Ticker', 'Close', 'ano', 'mes', 'dia']).to_pandas()
+    df['Ticker'] = df['Ticker'].astype(str)
+    # Earlier ingestion cycles appended the same rows several times
+    df = df.drop_duplicates(subset=['Datetime', 'Ticker'], keep='last')
+    logger.info(f"Migrating {len(df)} rows from {len(old_files)} files...")
+
+    if not save_to_datalake(optimize_dtypes(df), base_path):
+        logger.error("Writing the new layout failed, keeping the old files.")
+        return
+
+    old_set = set(old_files)
+    new_files = [f for f in ds.dataset(base_path, format='parquet').files if f not in old_set]
+    new_rows = ds.dataset(new_files, format='parquet').count_rows() if new_files else 0
+    if new_rows != len(df):
+        logger.error(f"New layout holds {new_rows} rows instead of {len(df)}, keeping the old files.")
+        return
+
+    for file_path in old_files:
+        os.remove(file_path)
+
+    # Index files written by previous engines describe the old layout
+    for name in ('_metadata', '_common_metadata'):
+        path = os.path.join(base_path, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    rebuild_metadata_index(base_path)
+    logger.info("Data Lake migration finished.")
+
+if __name__ == "__main__":
+    migrate_datalake(BASE_PATH)
@@ -0,0 +1,64 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'ingestion'))
+
+import ingestor
+from ingestor import optimize_dtypes, save_to_datalake
+
+
+def _ticks(closes: dict) -> pd.DataFrame:
+    datetimes = pd.to_datetime(list(closes))
+    return optimize_dtypes(pd.DataFrame({
+        'Datetime': datetimes,
+        'Ticker': 'PETR4.SA',
+        'Close': list(closes.values()),
+        'ano': datetimes.year,
+        'mes': datetimes.month,
+        'dia': datetimes.day,
+    }))
+
+
+def test_upsert_replaces_partition_file_and_keeps_index_readable(tmp_path):
+    base_path = str(tmp_path / 'datalake')
+
+    assert save_to_datalake(_ticks({'2024-05-02 10:00': 30.0, '2024-05-02 10:01': 30.5}), base_path)
+    first_files = set(ds.dataset(base_path, format='parquet').files)
+
+    assert save_to_datalake(_ticks({'2024-05-02 10:01': 31.0, '2024-05-02 10:02': 31.5}), base_path)
+    files = set(ds.dataset(base_path, format='parquet').files)
+
+    # One file per partition, under a new name: the previous one is deleted, not rewritten in place
+    assert len(files) == 1
+    assert not files & first_files
+
+    table = ds.parquet_dataset(f'{base_path}/_metadata', partitioning='hive').to_table().sort_by('Datetime')
+    assert table['Close'].to_pylist() == [30.0, 31.0, 31.5]
+
+
+def test_failed_index_update_is_remembered_and_leaves_no_tmp_file(tmp_path, monkeypatch):
+    base_path = str(tmp_path / 'datalake')
+    # A file with another schema (as in an unmigrated lake) makes the combined footers invalid
+    legacy_dir = tmp_path / 'datalake' / 'ano=2023' / 'mes=1' / 'dia=2' / 'Ticker=VALE3.SA'
+    legacy_dir.mkdir(parents=True)
+    pq.write_table(
+        pa.table({'Datetime': pa.array([pd.Timestamp('2023-01-02 10:00')]), 'Close': pa.array([1.0], pa.float64())}),
+        str(legacy_dir / 'old.parquet'),
+    )
+
+    assert save_to_datalake(_ticks({'2024-05-02 10:00': 30.0}), base_path)
+
+    assert base_path in ingestor._failed_indexes
+    assert not (tmp_path / 'datalake' / '_metadata').exists()
+    assert not (tmp_path / 'datalake' / '_metadata.tmp').exists()
+
+    def fail_read_footers(_):
+        raise AssertionError('footers re-read after a failed index update')
+
+    monkeypatch.setattr(ingestor, '_read_footers', fail_read_footers)
+    assert save_to_datalake(_ticks({'2024-05-03 10:00': 31.0}), base_path)
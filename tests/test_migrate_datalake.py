@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'ingestion'))
+
+from migrate_datalake import migrate_datalake
+
+
+def test_migration_moves_old_layout_rows_to_ticker_partitions(tmp_path):
+    base_path = tmp_path / 'datalake'
+    datetimes = pd.to_datetime(['2023-12-28', '2023-12-29', '2024-01-02'] * 2)
+    old = pa.table({
+        'Datetime': pa.array(datetimes),
+        'Ticker': ['PETR4.SA'] * 3 + ['VALE3.SA'] * 3,
+        'Close': pa.array([30.0, 30.5, 31.0, 60.0, 60.5, 61.0], pa.float32()),
+        'ano': pa.array(datetimes.year, pa.int16()),
+        'mes': pa.array(datetimes.month, pa.int8()),
+        'dia': pa.array(datetimes.day, pa.int8()),
+    })
+    # Earlier ingestion cycles appended the same rows again under new file names
+    for _ in range(2):
+        pq.write_to_dataset(old, str(base_path), partition_cols=['ano', 'mes', 'dia'])
+
+    migrate_datalake(str(base_path))
+
+    assert sorted(p.name for p in base_path.iterdir() if not p.name.startswith('_')) == [
+        'Ticker=PETR4.SA', 'Ticker=VALE3.SA'
+    ]
+    dataset = ds.dataset(str(base_path), format='parquet', partitioning='hive')
+    assert len(dataset.files) == 4
+    assert dataset.count_rows() == old.num_rows
+
+    indexed = ds.parquet_dataset(str(base_path / '_metadata'), partitioning='hive')
+    assert indexed.count_rows() == old.num_rows
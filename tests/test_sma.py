@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'dashboard'))
+
+from app import sma
+
+
+def _read_only(values: np.ndarray) -> np.ndarray:
+    values = values.copy()
+    values.flags.writeable = False
+    return values
+
+
+def test_sma_matches_pandas_rolling_mean_on_read_only_input():
+    x = _read_only(np.random.default_rng(0).uniform(10, 40, 200).astype(np.float32))
+
+    expected = pd.Series(x).rolling(20).mean().to_numpy()
+
+    np.testing.assert_allclose(sma(x, 20), expected, rtol=1e-5)
+
+
+def test_sma_skips_windows_with_missing_prices():
+    x = np.arange(60, dtype=np.float32)
+    x[30] = np.nan
+    x = _read_only(x)
+
+    expected = pd.Series(x).rolling(20).mean().to_numpy()
+
+    np.testing.assert_allclose(sma(x, 20), expected, rtol=1e-5)
+
+
+def test_sma_runs_on_zero_copy_arrow_buffer():
+    prices = np.random.default_rng(1).uniform(10, 40, 100).astype(np.float32)
+    # Same conversion load_filtered applies to the Close column
+    close = pa.array(prices, type=pa.float32()).to_numpy(zero_copy_only=False)
+    assert not close.flags.writeable
+
+    expected = pd.Series(prices).rolling(20).mean().to_numpy()
+
+    np.testing.assert_allclose(sma(close, 20), expected, rtol=1e-5)